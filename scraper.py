@@ -8,15 +8,25 @@ import json
 import logging
 import os
 import random
-from datetime import datetime
-from typing import Any, Dict, List, Optional
+import re
+import signal
+import time
+from datetime import date
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
 from dotenv import load_dotenv
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
 from playwright.sync_api import sync_playwright
 from playwright_stealth import Stealth
 
+if TYPE_CHECKING:
+    from google.oauth2.service_account import Credentials
+
+try:
+    import orjson
+except ImportError:  # Optional, faster auth.json parsing
+    orjson = None
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -34,12 +44,35 @@ CREDENTIALS_FILE = "credentials.json"
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID", "")
 SHEET_NAME = "Raw_Data"
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+APPEND_CHUNK_SIZE = 10000
+APPEND_ERROR_HINTS = {
+    400: "Bad request (400). Check your data format and range.",
+    403: "Permission denied (403). Verify you have edit access to the spreadsheet.",
+    404: "Spreadsheet not found (404). Verify SPREADSHEET_ID is correct.",
+}
+APPEARANCES_RE = re.compile(r"^\s*(\d+(?:\.\d+)?|\.\d+)\s*([kKmM]?)\s*$")
+APPEARANCES_MULTIPLIERS = {"": 1, "k": 1000, "m": 1_000_000}
+HEADLESS = os.getenv("HEADLESS", "true").lower() != "false"
+CDP_URL = os.getenv("CDP_URL", "")
+SCRAPE_INTERVAL = os.getenv("SCRAPE_INTERVAL", "0")  # Seconds; 0 runs once
+# Resource types blocked when reusing a browser over CDP; stylesheets stay allowed
+# because the expansion loop relies on layout to tell whether the button is visible
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font"}
+BROWSER_ARGS = [
+    "--disable-gpu",
+    "--disable-dev-shm-usage",
+    "--disable-extensions",
+    "--blink-settings=imagesEnabled=false",
+]
 
 
 def load_auth_storage() -> Optional[Dict[str, Any]]:
     """Load Playwright auth storage from auth.json."""
     try:
         if os.path.exists(AUTH_FILE):
+            if orjson is not None:
+                with open(AUTH_FILE, "rb") as f:
+                    return orjson.loads(f.read())
             with open(AUTH_FILE, "r") as f:
                 return json.load(f)
         logger.warning(f"{AUTH_FILE} not found. Starting without saved session.")
@@ -49,8 +82,29 @@ def load_auth_storage() -> Optional[Dict[str, Any]]:
         return None
 
 
-def load_google_credentials() -> Credentials:
+def load_scrape_interval() -> Optional[int]:
+    """
+    Parse SCRAPE_INTERVAL into seconds between scrapes.
+    Returns None if the value is not a non-negative integer.
+    """
+    try:
+        interval = int(SCRAPE_INTERVAL.strip() or "0")
+    except ValueError:
+        logger.error(f"SCRAPE_INTERVAL must be a whole number of seconds, got '{SCRAPE_INTERVAL}'.")
+        return None
+    
+    if interval < 0:
+        logger.error(f"SCRAPE_INTERVAL must not be negative, got {interval}.")
+        return None
+    
+    return interval
+
+
+def load_google_credentials() -> "Credentials":
     """Load Google Service Account credentials."""
+    # Imported lazily so the browser starts without waiting on Google libraries
+    from google.oauth2.service_account import Credentials
+    
     try:
         if not os.path.exists(CREDENTIALS_FILE):
             raise FileNotFoundError(
@@ -67,25 +121,34 @@ def load_google_credentials() -> Credentials:
         raise
 
 
+@lru_cache(maxsize=None)
+def get_sheets_service() -> Any:
+    """
+    Build the Google Sheets API client.
+    Cached so repeated syncs reuse the same credentials and client.
+    """
+    from googleapiclient.discovery import build
+    
+    credentials = load_google_credentials()
+    # Use the discovery document bundled with the client, skipping the fetch
+    return build(
+        "sheets", "v4", credentials=credentials,
+        cache_discovery=False, static_discovery=True
+    )
+
+
 def clean_appearances(text: str) -> int:
     """
     Clean appearances text and convert to integer.
-    Examples: '1.2k' -> 1200, '5' -> 5
+    Examples: '1.2k' -> 1200, '3M' -> 3000000, '5' -> 5
     """
-    try:
-        text = text.strip().lower()
-        
-        # Handle 'k' suffix (thousands)
-        if 'k' in text:
-            # Extract number and multiply by 1000
-            number = float(text.replace('k', ''))
-            return int(number * 1000)
-        
-        # Try direct conversion
-        return int(float(text))
-    except Exception as e:
-        logger.warning(f"Could not clean appearances text '{text}': {e}")
+    match = APPEARANCES_RE.match(text)
+    if not match:
+        logger.warning(f"Could not clean appearances text '{text}'")
         return 0
+    
+    number, suffix = match.groups()
+    return int(float(number) * APPEARANCES_MULTIPLIERS[suffix.lower()])
 
 
 def clean_rank(text: str) -> int:
@@ -94,9 +157,8 @@ def clean_rank(text: str) -> int:
     Examples: '#1' -> 1, '42' -> 42
     """
     try:
-        text = text.strip().replace('#', '')
-        return int(text)
-    except Exception as e:
+        return int(text.lstrip(" \t\n#"))
+    except ValueError as e:
         logger.warning(f"Could not clean rank text '{text}': {e}")
         return 0
 
@@ -110,28 +172,54 @@ def expand_keyword_table(page: Any) -> int:
     max_attempts = 100  # Prevent infinite loops
     
     try:
-        while expansion_count < max_attempts:
-            try:
-                # Look for the specific button with text "Voir plus de résultats"
-                voir_plus_button = page.locator('button:has-text("Voir plus de résultats")').first
-                
-                # Check if button exists and is visible and enabled
-                if not voir_plus_button.is_visible():
-                    logger.info("'Voir plus de résultats' button not found or not visible. All data loaded.")
-                    break
-                
-                # Click the button with small delay
-                voir_plus_button.click()
-                
-                # Wait for new entries to load
-                page.wait_for_timeout(2000)
-                
-                expansion_count += 1
-                logger.info(f"Expansion #{expansion_count} completed.")
-                
-            except Exception as e:
-                logger.debug(f"Error during expansion iteration: {e}")
-                break
+        # Click and wait for new rows inside the browser, so each expansion
+        # resolves as soon as rows are appended instead of after a fixed sleep
+        result = page.evaluate(
+            """async (maxAttempts) => {
+                const rowCount = () => document.querySelectorAll('.keywords__row').length;
+                const waitForNewRows = (before) => new Promise(resolve => {
+                    if (rowCount() > before) { resolve(true); return; }
+                    const observer = new MutationObserver(() => {
+                        if (rowCount() > before) { observer.disconnect(); resolve(true); }
+                    });
+                    observer.observe(document.body, {childList: true, subtree: true});
+                    setTimeout(() => { observer.disconnect(); resolve(false); }, 5000);
+                });
+                const findButton = () => [...document.querySelectorAll('button')].find(b =>
+                    b.textContent.replace(/\\s+/g, ' ').toLowerCase()
+                        .includes('voir plus de résultats'));
+                let count = 0;
+                while (count < maxAttempts) {
+                    const button = findButton();
+                    if (!button || button.disabled || button.getClientRects().length === 0) {
+                        return {count, reason: 'button'};
+                    }
+                    const before = rowCount();
+                    button.click();
+                    if (!await waitForNewRows(before)) return {count, reason: 'timeout'};
+                    count++;
+                }
+                return {count, reason: 'max_attempts'};
+            }""",
+            max_attempts,
+        )
+        expansion_count = result["count"]
+        
+        if result["reason"] == "timeout":
+            logger.warning(
+                f"Completed {expansion_count} expansions. "
+                "No new rows appeared within 5s after clicking; stopping."
+            )
+        elif result["reason"] == "max_attempts":
+            logger.warning(
+                f"Completed {expansion_count} expansions. "
+                f"Reached the limit of {max_attempts} expansions; stopping."
+            )
+        else:
+            logger.info(
+                f"Completed {expansion_count} expansions. "
+                "'Voir plus de résultats' button not found or not visible. All data loaded."
+            )
     
     except Exception as e:
         logger.error(f"Error in expand_keyword_table: {e}")
@@ -139,51 +227,44 @@ def expand_keyword_table(page: Any) -> int:
     return expansion_count
 
 
-def scrape_keyword_data(page: Any) -> List[Dict[str, Any]]:
+def scrape_keyword_data(page: Any) -> List[Tuple[str, int, int]]:
     """
     Extract keyword data from .keywords__row elements.
-    Returns list of dicts with: keyword, appearances, rank
+    Returns list of tuples: (keyword, appearances, rank)
     """
-    keywords_data: List[Dict[str, Any]] = []
+    keywords_data: List[Tuple[str, int, int]] = []
     
     try:
-        # Find all rows with class .keywords__row
-        rows = page.locator(".keywords__row").all()
+        # Read the text of every row's spans in a single browser round-trip
+        # Order: span[0]=keyword, span[1]=appearances, span[2]=rank
+        rows = page.locator(".keywords__row").evaluate_all(
+            """rows => rows.map(r => {
+                const s = r.querySelectorAll('span');
+                return s.length >= 3
+                    ? [s[0].textContent.trim(), s[1].textContent.trim(), s[2].textContent.trim()]
+                    : null;
+            })"""
+        )
         logger.info(f"Found {len(rows)} keyword rows.")
         
         for row in rows:
-            try:
-                # Get all span elements inside the row
-                spans = row.locator("span").all()
-                
-                # Need at least 3 spans: keyword, appearances, rank
-                if len(spans) < 3:
-                    logger.debug(f"Row has {len(spans)} spans, skipping (need at least 3).")
-                    continue
-                
-                # Extract text from spans and clean whitespace
-                # Order: span[0]=keyword, span[1]=appearances, span[2]=rank
-                keyword = spans[0].text_content().strip()
-                appearances_text = spans[1].text_content().strip()
-                rank_text = spans[2].text_content().strip()
-                
-                # Skip if keyword is empty
-                if not keyword:
-                    continue
-                
-                # Convert to proper types
-                appearances = clean_appearances(appearances_text)
-                rank = clean_rank(rank_text)
-                
-                keywords_data.append({
-                    "keyword": keyword,
-                    "appearances": appearances,
-                    "rank": rank
-                })
-                
-            except Exception as e:
-                logger.debug(f"Error extracting row data: {e}")
+            # Need at least 3 spans: keyword, appearances, rank
+            if row is None:
+                logger.debug("Row has fewer than 3 spans, skipping.")
                 continue
+            
+            keyword, appearances_text, rank_text = row
+            
+            # Skip if keyword is empty
+            if not keyword:
+                continue
+            
+            # Convert to proper types
+            keywords_data.append((
+                keyword,
+                clean_appearances(appearances_text),
+                clean_rank(rank_text)
+            ))
         
         logger.info(f"Successfully scraped {len(keywords_data)} keywords.")
         return keywords_data
@@ -193,7 +274,16 @@ def scrape_keyword_data(page: Any) -> List[Dict[str, Any]]:
         return []
 
 
-def sync_to_google_sheets(keywords_data: List[Dict[str, Any]]) -> bool:
+def log_partial_append(updated_rows: int, total_rows: int) -> None:
+    """Warn when a failed sync already appended some chunks to the sheet."""
+    if updated_rows:
+        logger.warning(
+            f"{updated_rows} of {total_rows} rows were already appended to '{SHEET_NAME}' "
+            "before the failure. Remove them before re-syncing to avoid duplicate rows."
+        )
+
+
+def sync_to_google_sheets(keywords_data: List[Tuple[str, int, int]]) -> bool:
     """
     Sync scraped data to Google Sheets.
     Appends rows with format: [Date, Keyword, Appearances, Rank]
@@ -211,66 +301,40 @@ def sync_to_google_sheets(keywords_data: List[Dict[str, Any]]) -> bool:
         masked_id = SPREADSHEET_ID[:10] + "..." + SPREADSHEET_ID[-10:] if len(SPREADSHEET_ID) > 20 else SPREADSHEET_ID
         logger.info(f"Using Spreadsheet ID: {masked_id}")
         
-        credentials = load_google_credentials()
-        service = build("sheets", "v4", credentials=credentials)
+        from googleapiclient.errors import HttpError
         
-        # Verify sheet exists or create it
-        try:
-            sheet_metadata = service.spreadsheets().get(
-                spreadsheetId=SPREADSHEET_ID,
-                fields="sheets.properties"
-            ).execute()
-            
-            sheets = sheet_metadata.get("sheets", [])
-            sheet_names = [sheet["properties"]["title"] for sheet in sheets]
-            
-            logger.info(f"Available sheets: {sheet_names}")
-            
-            if SHEET_NAME not in sheet_names:
-                logger.warning(f"Sheet '{SHEET_NAME}' not found. Available sheets: {sheet_names}")
-                logger.error(f"Please create a sheet named '{SHEET_NAME}' in your Google Sheet.")
-                return False
-            
-            logger.info(f"Sheet '{SHEET_NAME}' verified and exists.")
-            
-        except Exception as e:
-            logger.error(f"Error verifying sheet: {e}")
-            logger.error(f"Make sure SPREADSHEET_ID is correct and you have access to the spreadsheet.")
-            return False
+        service = get_sheets_service()
         
         # Get current date
-        today = datetime.now().strftime("%Y-%m-%d")
+        today = date.today().isoformat()
         
         # Prepare rows for batch append
         # Format: [date, keyword, appearances, rank]
-        rows: List[List[Any]] = []
-        for item in keywords_data:
-            row = [
-                today,
-                item["keyword"],
-                item["appearances"],
-                item["rank"]
-            ]
-            rows.append(row)
+        rows: List[List[Any]] = [
+            [today, *keyword_row]
+            for keyword_row in keywords_data
+        ]
         
         logger.info(f"Prepared {len(rows)} rows for batch append.")
         logger.debug(f"Sample row: {rows[0] if rows else 'No rows'}")
         
-        # Batch append to Google Sheets
-        body: Dict[str, List[List[Any]]] = {
-            "values": rows
-        }
-        
+        # Batch append to Google Sheets, chunked to keep request bodies bounded
+        # Chunks are appended one by one, so a failure can leave earlier chunks written
+        updated_rows = 0
         try:
-            result = service.spreadsheets().values().append(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{SHEET_NAME}!A:D",
-                valueInputOption="USER_ENTERED",
-                body=body
-            ).execute()
-            
-            updates = result.get("updates", {})
-            updated_rows = updates.get("updatedRows", 0)
+            values_resource = service.spreadsheets().values()
+            for start in range(0, len(rows), APPEND_CHUNK_SIZE):
+                body: Dict[str, List[List[Any]]] = {
+                    "values": rows[start:start + APPEND_CHUNK_SIZE]
+                }
+                result = values_resource.append(
+                    spreadsheetId=SPREADSHEET_ID,
+                    range=f"{SHEET_NAME}!A:D",
+                    valueInputOption="USER_ENTERED",
+                    insertDataOption="INSERT_ROWS",
+                    body=body
+                ).execute()
+                updated_rows += result.get("updates", {}).get("updatedRows", 0)
             
             logger.info(
                 f"Successfully synced {updated_rows} rows to Google Sheets "
@@ -278,19 +342,22 @@ def sync_to_google_sheets(keywords_data: List[Dict[str, Any]]) -> bool:
             )
             return True
             
-        except Exception as append_error:
-            # Provide detailed error information
-            error_message = str(append_error)
-            logger.error(f"Error appending rows to Google Sheets: {error_message}")
+        except HttpError as append_error:
+            # Provide detailed error information from the HTTP status
+            status = append_error.resp.status
+            logger.error(f"Error appending rows to Google Sheets ({status}): {append_error.reason}")
             
-            # Check for specific error types
-            if "403" in error_message:
-                logger.error("Permission denied (403). Verify you have edit access to the spreadsheet.")
-            elif "404" in error_message:
-                logger.error("Spreadsheet not found (404). Verify SPREADSHEET_ID is correct.")
-            elif "400" in error_message:
-                logger.error("Bad request (400). Check your data format and range.")
+            if status == 400 and "Unable to parse range" in append_error.reason:
+                logger.error(f"Please create a sheet named '{SHEET_NAME}' in your Google Sheet.")
+            elif status in APPEND_ERROR_HINTS:
+                logger.error(APPEND_ERROR_HINTS[status])
             
+            log_partial_append(updated_rows, len(rows))
+            return False
+        
+        except Exception as append_error:
+            logger.error(f"Error appending rows to Google Sheets: {append_error}")
+            log_partial_append(updated_rows, len(rows))
             return False
         
     except Exception as e:
@@ -298,64 +365,167 @@ def sync_to_google_sheets(keywords_data: List[Dict[str, Any]]) -> bool:
         return False
 
 
+def scrape_once(page: Any) -> Tuple[int, List[Tuple[str, int, int]]]:
+    """
+    Load the analytics page, expand the keyword table and scrape it.
+    Returns the number of expansions and the scraped keyword data.
+    """
+    # Navigate to Malt analytics
+    logger.info(f"Navigating to {MALT_URL}")
+    page.goto(MALT_URL, wait_until="commit", timeout=15000)
+    # Only the rendered keyword rows matter, not the rest of the page load
+    page.wait_for_selector(".keywords__row", timeout=15000)
+    
+    # Expand the keyword table
+    logger.info("Starting expansion loop...")
+    expansion_count = expand_keyword_table(page)
+    
+    # Scrape keyword data
+    logger.info("Extracting keyword data...")
+    keywords_data = scrape_keyword_data(page)
+    
+    return expansion_count, keywords_data
+
+
+def open_browser(p: Any) -> Any:
+    """Connect to the browser at CDP_URL, or launch a new one."""
+    if CDP_URL:
+        # Reuse an already running Chromium instead of cold-starting one
+        logger.info(f"Connecting to running browser at {CDP_URL}")
+        return p.chromium.connect_over_cdp(CDP_URL)
+    
+    # Launch browser with headless mode (images disabled, only DOM text is read)
+    return p.chromium.launch(headless=HEADLESS, args=BROWSER_ARGS)
+
+
+def open_scrape_page(browser: Any, auth_storage: Optional[Dict[str, Any]]) -> Tuple[Any, Any]:
+    """
+    Create a browser context with the saved session and a stealth page in it.
+    Returns the context and the page.
+    """
+    # Create context with auth storage
+    context_kwargs: Dict[str, Any] = {
+        "locale": "en-US",
+    }
+    
+    if auth_storage:
+        context_kwargs["storage_state"] = auth_storage
+    
+    context = browser.new_context(**context_kwargs)
+    try:
+        if CDP_URL:
+            # BROWSER_ARGS do not apply to an external browser, so block
+            # resources here; routing disables the HTTP cache, hence
+            # launched browsers rely on the launch flags instead
+            context.route(
+                "**/*",
+                lambda route: route.abort()
+                if route.request.resource_type in BLOCKED_RESOURCE_TYPES
+                else route.continue_()
+            )
+        page = context.new_page()
+        
+        # Apply stealth mode using the correct class method
+        Stealth().apply_stealth_sync(page)
+        
+        return context, page
+    
+    except Exception:
+        close_context(context)
+        raise
+
+
+def close_context(context: Any) -> None:
+    """Close a browser context, ignoring errors from an already dead browser."""
+    try:
+        context.close()
+    except Exception as e:
+        logger.debug(f"Error closing browser context: {e}")
+
+
 def main() -> int:
     """Main scraper execution."""
-    expansion_count = 0
-    scraped_count = 0
+    scrape_interval = load_scrape_interval()
+    if scrape_interval is None:
+        return 1
+    
+    if scrape_interval:
+        # Continuous mode only stops on a signal; let SIGTERM shut down like Ctrl+C
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
     
     try:
         # Load auth storage
         auth_storage = load_auth_storage()
         
         with sync_playwright() as p:
-            # Launch browser with headless mode
-            browser = p.chromium.launch(headless=False)
-            
-            # Create context with auth storage
-            context_kwargs: Dict[str, Any] = {
-                "locale": "en-US",
-            }
-            
-            if auth_storage:
-                context_kwargs["storage_state"] = auth_storage
-            
-            context = browser.new_context(**context_kwargs)
-            page = context.new_page()
-            
-            # Apply stealth mode using the correct class method
-            Stealth().apply_stealth_sync(page)
-            
-            # Navigate to Malt analytics
-            logger.info(f"Navigating to {MALT_URL}")
-            page.goto(MALT_URL, wait_until="domcontentloaded")
-            page.wait_for_selector(".keywords__row", timeout=15000)
-
-            # Expand the keyword table
-            logger.info("Starting expansion loop...")
-            expansion_count = expand_keyword_table(page)
-            
-            # Scrape keyword data
-            logger.info("Extracting keyword data...")
-            keywords_data = scrape_keyword_data(page)
-            scraped_count = len(keywords_data)
+            browser = open_browser(p)
+            context = None
             
-            # Close browser
-            browser.close()
-        
-        # Sync to Google Sheets
-        logger.info("Syncing data to Google Sheets...")
-        sync_successful = sync_to_google_sheets(keywords_data)
-        
-        # Print final summary
-        print(f"\n{'='*60}")
-        print(f"Scraping Complete!")
-        print(f"{'='*60}")
-        print(f"Expanded {expansion_count} times. Scraped {scraped_count} keywords.")
-        print(f"Google Sheets Sync: {'✓ Success' if sync_successful else '✗ Failed'}")
-        print(f"{'='*60}\n")
+            try:
+                context, page = open_scrape_page(browser, auth_storage)
+                
+                while True:
+                    try:
+                        expansion_count, keywords_data = scrape_once(page)
+                        scraped_count = len(keywords_data)
+                        
+                        # Sync to Google Sheets
+                        logger.info("Syncing data to Google Sheets...")
+                        sync_successful = sync_to_google_sheets(keywords_data)
+                        
+                        # Print final summary
+                        print(f"\n{'='*60}")
+                        print(f"Scraping Complete!")
+                        print(f"{'='*60}")
+                        print(f"Expanded {expansion_count} times. Scraped {scraped_count} keywords.")
+                        print(f"Google Sheets Sync: {'✓ Success' if sync_successful else '✗ Failed'}")
+                        print(f"{'='*60}\n")
+                        
+                        if scrape_interval:
+                            # Leave the expanded dashboard while sleeping: route handlers
+                            # cannot run during time.sleep, and its DOM would stay in memory
+                            page.goto("about:blank")
+                    
+                    except Exception as e:
+                        if not scrape_interval:
+                            raise
+                        # A failed pass must not stop continuous collection
+                        logger.error(f"Scrape pass failed: {e}", exc_info=True)
+                        sync_successful = False
+                        
+                        # The page may have crashed or the browser restarted, so
+                        # start the next pass from a fresh context; if that fails
+                        # too, the error ends the process for a supervisor to restart
+                        close_context(context)
+                        context = None
+                        if not browser.is_connected():
+                            logger.warning("Browser connection lost. Reopening browser...")
+                            browser = open_browser(p)
+                        context, page = open_scrape_page(browser, auth_storage)
+                    
+                    if not scrape_interval:
+                        break
+                    
+                    # Keep the browser and session alive until the next pass
+                    logger.info(f"Next scrape in {scrape_interval} seconds.")
+                    time.sleep(scrape_interval)
+            finally:
+                # Always close our context so no session is left in a shared browser
+                if context is not None:
+                    close_context(context)
+                # Leave a shared browser running for the next run
+                if not CDP_URL:
+                    try:
+                        browser.close()
+                    except Exception as e:
+                        logger.debug(f"Error closing browser: {e}")
         
         return 0 if sync_successful else 1
         
+    except KeyboardInterrupt:
+        logger.info("Interrupted. Stopping scraper.")
+        return 0
+        
     except Exception as e:
         logger.error(f"Fatal error in main execution: {e}", exc_info=True)
         print(f"\nError: {e}")